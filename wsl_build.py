@@ -1,12 +1,36 @@
-import sublime, sublime_plugin, subprocess, re
+import sublime, sublime_plugin, subprocess, functools, re
 
 from Default.exec import ExecCommand
 
+# Build variables holding paths that must be converted for Linux
+_UNIX_VARS = ("file", "file_path", "folder", "project_path")
+
+# WSLENV flags that may be appended to "wsl_env" keys
+_WSLENV_FLAGS = ("/l", "/p", "/u", "/w")
+
+_UNC_PREFIX = "\\\\wsl.localhost\\Ubuntu"
+_UNC_PREFIX_LEN = len(_UNC_PREFIX)
+
+# Mount point of each Windows drive letter, in either case
+_MNT = {letter: "/mnt/" + letter.lower()
+        for letter in "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz"}
+
+_SLASH_TBL = str.maketrans("\\", "/")
+
+# Plain $name and ${name} references, which _expand handles itself
+_VAR_RE = re.compile(r"\$(?:([A-Za-z_][A-Za-z0-9_]*)"
+                     r"|\{([A-Za-z_][A-Za-z0-9_]*)\})")
+
+# Escapes, $1 style references and ${name:default} or ${name/re/fmt/}
+# forms, which are left to sublime.expand_variables
+_COMPLEX_VAR_RE = re.compile(r"\\\$|\$[0-9]|\$\{(?![A-Za-z_][A-Za-z0-9_]*\})")
+
 """
 Adds a "wsl_exec" target for build commands that does the following:
 
 - execute Linux commands
-- provides Linux paths in variables such as $file
+- provides Linux paths in variables such as $file (files in the WSL filesystem
+  or on a Windows drive under /mnt)
 - properly set ENV variables for Linux commands
 
 REQUIRED
@@ -19,6 +43,8 @@ Build variables such as $file will have Linux paths.
 
 Set "wsl_env" instead of "env" to set environment variables that are available to
 the Linux command. Build variables such as $file will have Linux paths.
+Keys may end with a WSLENV flag such as "/p" or "/u"; the flag is kept in
+WSLENV and removed from the variable name.
 
 Example Build Systems for a Rails app in WSL:
 "build_systems": [
@@ -51,19 +77,63 @@ Example Build Systems for a Rails app in WSL:
     }
 
 """
-class WslExecCommand(ExecCommand):
-    def run(self, **kwargs):
-        # Convert path variables to their wsl version
-        variables = self.window.extract_variables()
-        variables["file"] = self.wsl_path(variables["file"])
-        variables["file_path"] = self.wsl_path(variables["file_path"])
-        variables["folder"] = self.wsl_path(variables["folder"])
-        variables["project_path"] = self.wsl_path(variables["project_path"])
+@functools.lru_cache(maxsize=8)
+def _build_wslenv(items):
+    # Returns the env items to pass on, with any WSLENV flag removed from
+    # their names, followed by the matching WSLENV item
+    stripped = tuple((key[:-2] if key.endswith(_WSLENV_FLAGS) else key, value)
+                     for key, value in items)
+    return stripped + (("WSLENV", ":".join(key for key, value in items)),)
+
 
+def _any_string(obj, test):
+    # Whether test() is true for any string in a build argument
+    if isinstance(obj, str):
+        return test(obj)
+    if isinstance(obj, dict):
+        return any(_any_string(key, test) or _any_string(value, test)
+                   for key, value in obj.items())
+    if isinstance(obj, list):
+        return any(_any_string(item, test) for item in obj)
+    return False
 
+
+def _has_var(obj):
+    # Whether a build argument contains anything for expand_variables to do
+    return _any_string(obj, lambda string: "$" in string)
+
+
+def _has_complex_var(obj):
+    # Whether a build argument needs Sublime's own variable parser
+    return _any_string(obj, _COMPLEX_VAR_RE.search)
+
+
+def _expand(obj, replace):
+    # Minimal sublime.expand_variables for arguments without complex references
+    if isinstance(obj, str):
+        return _VAR_RE.sub(replace, obj)
+    if isinstance(obj, dict):
+        return {key: _expand(value, replace) for key, value in obj.items()}
+    if isinstance(obj, list):
+        return [_expand(item, replace) for item in obj]
+    return obj
+
+
+class WslExecCommand(ExecCommand):
+    def run(self, **kwargs):
         # Create arguments to return by expanding variables in the
-        # arguments given.
-        args = sublime.expand_variables (kwargs, variables)
+        # arguments given. Arguments without variables are copied as is.
+        needs_expand = {k: v for k, v in kwargs.items() if _has_var(v)}
+        args = {k: v for k, v in kwargs.items() if k not in needs_expand}
+        if needs_expand:
+            variables = self.convert_variables()
+            if _has_complex_var(needs_expand):
+                args.update(sublime.expand_variables(needs_expand, variables))
+            else:
+                def replace(match):
+                    # Undefined variables expand to "", as in Sublime
+                    return variables.get(match.group(1) or match.group(2), "")
+                args.update(_expand(needs_expand, replace))
 
         # Rename the command paramter to what exec expects.
         working_dir = args.pop("wsl_working_dir", None)
@@ -74,18 +144,31 @@ class WslExecCommand(ExecCommand):
 
         super().run(**args)
 
+    def convert_variables(self):
+        # Convert path variables to their wsl version
+        variables = self.window.extract_variables()
+        wsl_path = self.wsl_path
+        for var in _UNIX_VARS:
+            variables[var] = wsl_path(variables[var])
+        return variables
+
     def wsl_path(self, string):
-        prefix_removed = re.sub("\\\\\\\\wsl.localhost\\\\Ubuntu", "", string)
-        return re.sub("\\\\", "/", prefix_removed)
+        if "\\" not in string:
+            # Already a Linux path
+            return string
+        if string.startswith(_UNC_PREFIX):
+            string = string[_UNC_PREFIX_LEN:]
+        elif (len(string) > 2 and string[1] == ":" and string[2] == "\\"
+              and string[0] in _MNT):
+            # Windows drive, e.g. C:\Users -> /mnt/c/Users
+            string = _MNT[string[0]] + string[2:]
+        return string.translate(_SLASH_TBL)
 
     def wsl_cmd(self, cmd_ary, working_dir):
-        result = ["wsl"]
         if working_dir:
-            result += ["cd", working_dir, "&&"]
-        result += cmd_ary
-        return result
+            return ["wsl", "cd", working_dir, "&&"] + cmd_ary
+        return ["wsl"] + cmd_ary
 
 
-    def wsl_env(self, dict):
-        dict["WSLENV"] = ":".join(dict.keys())
-        return dict
+    def wsl_env(self, env):
+        return dict(_build_wslenv(tuple(env.items())))